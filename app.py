@@ -1,9 +1,14 @@
 import streamlit as st
 import pretty_midi
-import io
-import random
+import symusic
+import numpy as np
 import os
+import asyncio
+import copy
+import hashlib
+import threading
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import time
 
 # ページ設定
@@ -16,133 +21,282 @@ st.set_page_config(
 st.title("🎹 Piano Humanizer AI v3.4 (エラー修正版)")
 st.caption("Powered by Google Gemini 2.0 Flash")
 
+# --- MIDI読み込み ---
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_midi(midi_file_data):
+    """
+    バイナリデータからsymusicのScoreを作成する (時間単位は秒)
+    同じファイルの再解析を避けるためキャッシュする。キャッシュからは毎回コピーが返るため、呼び出し側で書き換えてもよい
+    """
+    return symusic.Score.from_midi(midi_file_data, ttype="second")
+
+def get_track_names(score):
+    """
+    トラック選択用の表示名を返す (名前の無いトラックは番号と音色名で表す)
+    """
+    return [t.name if t.name else f"Track {idx+1} ({pretty_midi.program_to_instrument_name(t.program)})" for idx, t in enumerate(score.tracks)]
+
+# --- 進捗表示 ---
+PROGRESS_UPDATE_INTERVAL = 0.1 # 進捗バーを更新する最短間隔 (秒)
+
+def make_progress_updater(progress_bar):
+    """
+    進捗バーの更新を一定時間ごとに間引く関数を返す (完了 (1.0) は必ず反映する)
+    """
+    next_update_at = 0.0
+
+    def update_progress(value):
+        nonlocal next_update_at
+        now = time.monotonic()
+        if value >= 1.0 or now >= next_update_at:
+            progress_bar.progress(min(value, 1.0))
+            next_update_at = now + PROGRESS_UPDATE_INTERVAL
+
+    return update_progress
+
 # --- ロジック1: 統計的ヒューマナイズ ---
-def apply_statistical_humanize(note, vel_std, time_std):
+rng = np.random.default_rng() # 乱数生成器 (旧来のnp.random.normalより高速なGeneratorを使う)
+
+def apply_statistical_humanize(track, vel_std, time_std, start=0, stop=None):
+    """
+    トラック内のノート (start〜stop) をNumPy配列としてまとめて取り出し、一括でばらつきを加える
+    """
+    arrays = track.notes.numpy()
+    target = slice(start, stop)
+    pitch = arrays['pitch'][target]
+    velocity = arrays['velocity'][target]
+    note_start = arrays['time'][target]
+    duration = arrays['duration'][target]
+    num_notes = len(pitch)
+
+    # ベロシティとタイミングのノイズを1回の呼び出しでまとめて生成
+    velocity_noise, timing_noise = rng.normal(0, [[vel_std * 20], [time_std * 0.05]], (2, num_notes))
+
     # ベロシティにランダムなばらつきを追加
-    velocity_noise = random.gauss(0, vel_std * 20)
-    pitch_bias = 3 if note.pitch > 72 else 0
-    new_velocity = int(note.velocity + velocity_noise + pitch_bias)
-    note.velocity = max(1, min(127, new_velocity))
+    pitch_bias = np.where(pitch > 72, 3, 0)
+    new_velocity = (velocity + velocity_noise + pitch_bias).astype(np.int32)
+    velocity[:] = np.clip(new_velocity, 1, 127)
 
     # タイミングにランダムな揺らぎを追加
-    timing_noise = random.gauss(0, time_std * 0.05)
-    new_start = max(0, note.start + timing_noise)
-    new_end = max(new_start + 0.1, note.end + timing_noise)
-    note.start = new_start
-    note.end = new_end
+    new_start = np.maximum(0, note_start + timing_noise)
+    new_end = np.maximum(new_start + 0.1, note_start + duration + timing_noise)
+    note_start[:] = new_start
+    duration[:] = new_end - new_start
+
+    # 配列からノート列を一括で再構築
+    track.notes = symusic.Note.from_numpy(**arrays, ttype="second")
 
 # --- ロジック2: Gemini AI ヒューマナイズ ---
-def apply_gemini_humanize(pm, api_key, progress_bar, selected_instruments):
+GEMINI_CHUNK_SIZE = 300 # 1回のAPIコールで処理するノート数
+GEMINI_MAX_CONCURRENCY = 5 # 同時に送信するAPIリクエスト数の上限
+GEMINI_REQUESTS_PER_MINUTE = 10 # 無料枠のレート制限 (1分あたりのリクエスト数)
+GEMINI_REQUEST_INTERVAL = 60 / GEMINI_REQUESTS_PER_MINUTE # リクエスト送信間隔の下限 (秒)
+GEMINI_MAX_RETRIES = 3 # レート制限 (429) に当たった場合の再試行回数
+GEMINI_RETRY_BACKOFF = 10 # 再試行までの待ち時間の初期値 (秒、再試行ごとに倍にする)
+GEMINI_MODEL_NAME = 'gemini-2.0-flash-exp'
+
+# 全チャンク共通の指示文 (system_instructionとして渡すため、チャンクごとに変わる値は含めない)
+GEMINI_SYSTEM_PROMPT = """
+You are a professional musician playing the instrument given in each request.
+Please determine the velocity (1-127) for each note in the given sequence to create a human-like, expressive performance.
+Consider phrasing and dynamics naturally for this instrument.
+
+Input Format: (Pitch, Duration), (Pitch, Duration)...
+
+Requirement:
+- Return ONLY a JSON array of integer velocities.
+- The number of velocities MUST match the number of input notes exactly.
+"""
+
+# チャンクごとに送る部分のテンプレート (共通の指示文はsystem_instruction側にあるため、変わる値だけを埋め込む)
+GEMINI_CHUNK_PROMPT = """
+Instrument: {instrument}
+Input Data: [{notes}]
+Number of notes: {num_notes}
+"""
+
+@st.cache_data(max_entries=1024, show_spinner=False)
+def request_gemini_velocities(prompt, num_notes, api_key_hash, _model, _wait_for_rate_limit):
+    """
+    1チャンク分のベロシティ列をGeminiに生成させる
+    (同じプロンプト (トラック名とフレーズを含む)・同じAPIキーの組み合わせは、APIを呼ばずにキャッシュから返す)
+    """
+    # 出力を整数のJSON配列に限定し、ノート数に見合ったトークン数で打ち切る
+    generation_config = genai.GenerationConfig(
+        response_mime_type='application/json',
+        response_schema=list[int],
+        max_output_tokens=num_notes * 4 + 32
+    )
+    
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        _wait_for_rate_limit()
+        velocities = []
+        pending = ''
+        
+        try:
+            # Geminiにストリーミングで生成させ、届いた分から順に数値リストへ変換する
+            for response in _model.generate_content(prompt, generation_config=generation_config, stream=True):
+                text_result = pending + response.text.replace('[', '').replace(']', '')
+                *values, pending = text_result.split(',') # 最後の値は次の応答に続く可能性があるので保留
+                velocities.extend(int(v) for v in values if v.strip())
+            break
+        except google_exceptions.ResourceExhausted:
+            # レート制限に当たった場合は待ち時間を延ばしながら再試行する
+            if attempt == GEMINI_MAX_RETRIES:
+                raise
+            time.sleep(GEMINI_RETRY_BACKOFF * 2 ** attempt)
+    
+    if pending.strip():
+        velocities.append(int(pending))
+    
+    # ノート数が一致しない結果はずれて適用されてしまうため、エラーとして扱う (キャッシュもされない)
+    if len(velocities) != num_notes:
+        raise ValueError(f"expected {num_notes} velocities, got {len(velocities)}")
+    return velocities
+
+async def request_gemini_chunks(model, api_key_hash, jobs, update_progress):
+    """
+    チャンクごとのGeminiリクエストを並行して送信し、ジョブ番号ごとのベロシティ列 (失敗時は例外) を返す
+    """
+    semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+    rate_lock = threading.Lock()
+    next_request_at = time.monotonic()
+
+    # キャッシュに無いチャンクだけがAPIを呼ぶため、レート制限は実際のリクエスト直前に (ワーカースレッド上で) 待つ
+    def wait_for_rate_limit():
+        nonlocal next_request_at
+        with rate_lock:
+            delay = next_request_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_request_at = max(next_request_at, time.monotonic()) + GEMINI_REQUEST_INTERVAL
+
+    async def process_chunk(job_indices):
+        instrument, _, _, pitches, durations, _ = jobs[job_indices[0]]
+        # (音高, 音長)のリストをプロンプト用に整形 (ノートオブジェクトの属性は参照せず、配列のビューから一括で作る)
+        notes_str = ", ".join(map("({0},{1:.2f})".format, pitches.tolist(), durations.tolist()))
+        
+        prompt = GEMINI_CHUNK_PROMPT.format(instrument=instrument.name, notes=notes_str, num_notes=len(pitches))
+        
+        try:
+            async with semaphore:
+                velocities = await asyncio.to_thread(
+                    request_gemini_velocities, prompt, len(pitches), api_key_hash, model, wait_for_rate_limit
+                )
+            return job_indices, velocities
+        except Exception as e:
+            return job_indices, e
+
+    # 同じトラック名で (音高, 音長) の並びが同じチャンクは1回だけ問い合わせ、結果を共有する
+    unique_jobs = {}
+    for job_idx, (instrument, _, _, pitches, durations, _) in enumerate(jobs):
+        prompt_key = (instrument.name, tuple(zip(pitches.tolist(), durations.round(2).tolist())))
+        unique_jobs.setdefault(prompt_key, []).append(job_idx)
+
+    results = [None] * len(jobs)
+    tasks = [process_chunk(job_indices) for job_indices in unique_jobs.values()]
+    done = 0
+    
+    # 完了した順に進捗バーを更新
+    for future in asyncio.as_completed(tasks):
+        job_indices, result = await future
+        for job_idx in job_indices:
+            results[job_idx] = result
+        done += len(job_indices)
+        update_progress(done / len(jobs))
+
+    return results
+
+def apply_gemini_humanize(score, api_key, update_progress, selected_instruments):
     """
     Gemini APIを使用して、選択されたインストゥルメントのMIDIデータから推奨されるベロシティ列を生成する
     """
     clean_key = api_key.strip()
     genai.configure(api_key=clean_key)
-    
-    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    # キャッシュのキーにはAPIキーそのものではなくハッシュ値を使う (他ユーザーの結果と混ざらないように)
+    api_key_hash = hashlib.sha256(clean_key.encode()).hexdigest()
 
     # 選択されたインストゥルメントのみを対象とする
-    target_instruments = [inst for inst in pm.instruments if inst.name in selected_instruments]
+    target_instruments = [inst for inst, name in zip(score.tracks, get_track_names(score)) if name in selected_instruments]
     
     if not target_instruments:
         st.warning("処理対象のトラックが選択されていません。")
-        return pm
+        return score
 
     status_text = st.empty()
     
-    total_instruments = len(target_instruments)
+    # 全トラックのチャンクを (トラック, 開始位置, 終了位置, 音高, 音長, ベロシティ) のジョブとしてまとめる
+    # ノート情報はトラック単位で配列として取り出し、チャンクにはコピーせずビューを渡す
+    jobs = []
+    track_arrays = []
+    for instrument in target_instruments:
+        arrays = instrument.notes.numpy()
+        track_arrays.append((instrument, arrays))
+        pitches = arrays['pitch']
+        durations = arrays['duration']
+        velocities = arrays['velocity']
+        num_notes = len(pitches)
+        for lo in range(0, num_notes, GEMINI_CHUNK_SIZE):
+            hi = min(lo + GEMINI_CHUNK_SIZE, num_notes)
+            jobs.append((instrument, lo, hi, pitches[lo:hi], durations[lo:hi], velocities[lo:hi]))
     
-    for inst_idx, instrument in enumerate(target_instruments):
-        notes = instrument.notes
-        
-        chunk_size = 300 # 1回のAPIコールで処理するノート数
-        chunks = [notes[i:i + chunk_size] for i in range(0, len(notes), chunk_size)]
-        total_chunks = len(chunks)
-        
-        status_text.text(f"Track {instrument.name}: Geminiが演奏データを生成中... ({len(notes)}音)")
+    total_notes = sum(len(inst.notes) for inst in target_instruments)
+    status_text.text(f"Geminiが演奏データを生成中... ({len(target_instruments)}トラック, {total_notes}音)")
+    
+    # 共通の指示文はsystem_instructionとして一度だけ設定する
+    # (明示的なコンテキストキャッシュは約1024トークン以上が条件で、この指示文は短すぎるため使わない)
+    model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=GEMINI_SYSTEM_PROMPT)
+    results = asyncio.run(request_gemini_chunks(model, api_key_hash, jobs, update_progress))
+    
+    failed_jobs = []
+    
+    for (instrument, lo, hi, _, _, velocity_view), velocities in zip(jobs, results):
+        if isinstance(velocities, Exception):
+            st.warning(f"Track {instrument.name}, Chunk {lo // GEMINI_CHUNK_SIZE + 1} failed: {velocities}. Skipping AI processing for this part.")
+            failed_jobs.append((instrument, lo, hi))
+            continue
         
-        for i, chunk in enumerate(chunks):
-            # (音高, 音長)のリストをプロンプト用に整形
-            notes_str = ", ".join([f"({n.pitch},{n.end - n.start:.2f})" for n in chunk])
-            
-            prompt = f"""
-            You are a professional musician playing the instrument: {instrument.name}.
-            Please determine the velocity (1-127) for each note in the following sequence to create a human-like, expressive performance.
-            Consider phrasing and dynamics naturally for this instrument.
-            
-            Input Format: (Pitch, Duration), (Pitch, Duration)...
-            Input Data: [{notes_str}]
-            
-            Requirement:
-            - Return ONLY a list of integer velocities separated by commas.
-            - Do not include any other text or brackets.
-            - The number of velocities MUST match the number of input notes exactly ({len(chunk)} notes).
-            """
-            
-            try:
-                # Geminiに生成させる
-                response = model.generate_content(prompt)
-                
-                # 結果をパースして数値リストに変換
-                text_result = response.text.strip()
-                text_result = text_result.replace('[', '').replace(']', '').replace('\n', ' ')
-                velocities = [int(v.strip()) for v in text_result.split(',') if v.strip().isdigit()]
-                
-                # 適用
-                for j, vel in enumerate(velocities):
-                    if j < len(chunk):
-                        chunk[j].velocity = max(1, min(127, vel))
-                
-                # 進捗バー更新
-                current_progress = (inst_idx / total_instruments) + ((i + 1) / total_chunks) * (1 / total_instruments)
-                progress_bar.progress(min(current_progress, 1.0))
-                
-                time.sleep(1) # APIレート制限への配慮
+        # 適用 (トラックのベロシティ配列のビューへ一括で書き込む)
+        velocity_view[:] = np.clip(velocities, 1, 127)
 
-            except Exception as e:
-                st.warning(f"Track {instrument.name}, Chunk {i+1} failed: {e}. Skipping AI processing for this part.")
-                # エラー時は統計的処理でフォールバック
-                for note in chunk:
-                    apply_statistical_humanize(note, 0.3, 0.1)
+    # 書き込んだ配列からトラックごとにノート列を一括で再構築
+    for instrument, arrays in track_arrays:
+        instrument.notes = symusic.Note.from_numpy(**arrays, ttype="second")
+
+    # エラーになったチャンクは統計的処理でフォールバック
+    # (ノート列を再構築するため、全チャンクのベロシティ適用後にまとめて行う)
+    for instrument, lo, hi in failed_jobs:
+        apply_statistical_humanize(instrument, 0.3, 0.1, lo, hi)
 
     status_text.text("Geminiによる演奏生成が完了しました！")
-    return pm
+    return score
 
 # --- メイン処理関数 ---
-def process_midi(midi_file_data, mode, vel_std, time_std, api_key, selected_instruments):
-    try:
-        # バイナリデータからPrettyMIDIオブジェクトを再構築
-        pm = pretty_midi.PrettyMIDI(io.BytesIO(midi_file_data))
-    except Exception as e:
-        st.error(f"MIDI読み込みエラー: {e}")
-        return None
+def process_midi(source_score, mode, vel_std, time_std, api_key, selected_instruments):
+    # セッションに保存された解析済みScoreを書き換えないよう、コピーに対して処理する
+    score = copy.deepcopy(source_score)
 
     # プログレスバー
     progress_bar = st.progress(0)
+    update_progress = make_progress_updater(progress_bar)
 
     if mode == "Gemini":
         if not api_key:
             st.error("APIキーが必要です。")
             return None
-        pm = apply_gemini_humanize(pm, api_key.strip(), progress_bar, selected_instruments)
+        score = apply_gemini_humanize(score, api_key.strip(), update_progress, selected_instruments)
         
     else:
         # 統計モード：選択されたトラックのみを処理
-        target_instruments = [inst for inst in pm.instruments if inst.name in selected_instruments]
-        
-        total_notes = sum([len(i.notes) for i in target_instruments])
-        processed_notes = 0
+        target_instruments = [inst for inst, name in zip(score.tracks, get_track_names(score)) if name in selected_instruments]
         
-        for instrument in target_instruments:
+        for idx, instrument in enumerate(target_instruments):
             if instrument.is_drum: continue
-            for note in instrument.notes:
-                apply_statistical_humanize(note, vel_std, time_std)
-                processed_notes += 1
-                if total_notes > 0 and processed_notes % 100 == 0:
-                    progress_bar.progress(processed_notes / total_notes)
+            apply_statistical_humanize(instrument, vel_std, time_std)
+            update_progress((idx + 1) / len(target_instruments))
         progress_bar.progress(1.0)
 
-    return pm
+    return score
 
 # --- UI構築 ---
 
@@ -187,16 +341,15 @@ with col_main:
         # ファイルが新しくアップロードされたらセッション状態を更新
         if st.session_state['midi_data'] is None or st.session_state['midi_data']['name'] != uploaded_file.name:
             try:
-                # 処理用にPrettyMIDIオブジェクトを作成
-                pm = pretty_midi.PrettyMIDI(uploaded_file)
-                # インストゥルメント情報とファイルデータ本体を保存
-                instrument_names = [i.name if i.name else f"Track {idx+1} ({pretty_midi.instrument_name_to_program(i.program)})" for idx, i in enumerate(pm.instruments)]
-                uploaded_file.seek(0) # ファイルポインタを先頭に戻す
-                midi_bytes = uploaded_file.read() # ファイルのバイナリデータを読み取る
-
-                # セッションステートにバイナリデータと名前、トラック情報を保存
+                midi_bytes = uploaded_file.getvalue() # ファイルのバイナリデータを取得 (シーク不要)
+                # 処理用にScoreを作成 (同じファイルの再アップロード時はキャッシュを使う)
+                score = load_midi(midi_bytes)
+                # インストゥルメント情報を取得
+                instrument_names = get_track_names(score)
+
+                # セッションステートに解析済みのScoreと名前、トラック情報を保存 (変換実行時に再解析しない)
                 st.session_state['midi_data'] = {
-                    'bytes': midi_bytes, 
+                    'score': score, 
                     'name': uploaded_file.name, 
                     'instruments': instrument_names
                 }
@@ -228,15 +381,14 @@ with col_main:
                     st.error("⚠️ Geminiモードを使用するには右側の設定パネルでAPIキーを入力してください。")
                 else:
                     with st.spinner("処理中..."):
-                        # セッションステートからバイナリデータを取得
-                        midi_file_data = st.session_state['midi_data']['bytes']
+                        # セッションステートから解析済みのScoreを取得
+                        source_score = st.session_state['midi_data']['score']
                         
                         v_param = velocity_amount if mode != "Gemini" else 0
                         t_param = timing_amount if mode != "Gemini" else 0
                         
-                        # バイナリデータ（midi_file_data）を渡すように変更
-                        processed_pm = process_midi(
-                            midi_file_data, 
+                        processed_score = process_midi(
+                            source_score, 
                             mode, 
                             v_param, 
                             t_param, 
@@ -244,17 +396,15 @@ with col_main:
                             selected_instruments
                         )
                         
-                        if processed_pm:
+                        if processed_score:
                             # 処理後のMIDIをバイナリデータとして書き出す
-                            bio = io.BytesIO()
-                            processed_pm.write(bio)
-                            bio.seek(0)
+                            midi_out = processed_score.dumps_midi()
                             
                             st.balloons()
                             st.success("完了しました！")
                             st.download_button(
                                 label="🎹 Humanized MIDIをダウンロード",
-                                data=bio,
+                                data=midi_out,
                                 file_name=f"humanized_{st.session_state['midi_data']['name']}",
                                 mime="audio/midi",
                                 use_container_width=True